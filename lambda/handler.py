@@ -2,8 +2,11 @@ import os
 import boto3
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
 from urllib.parse import unquote_plus
-from pathlib import Path
 
 # Configure logging
 logger = logging.getLogger()
@@ -14,39 +17,96 @@ ecs = boto3.client('ecs')
 s3 = boto3.client('s3')
 
 # Supported video file extensions
-SUPPORTED_VIDEO_EXTENSIONS = {
-    '.mp4', '.mov', '.avi', '.mkv', '.wmv', '.flv', '.webm', 
-    '.m4v', '.3gp', '.ogv', '.ts', '.mts', '.m2ts'
-}
+SUPPORTED_VIDEO_EXTENSIONS = frozenset({
+    'mp4', 'mov', 'avi', 'mkv', 'wmv', 'flv', 'webm',
+    'm4v', '3gp', 'ogv', 'ts', 'mts', 'm2ts'
+})
 
 # Minimum file size (in bytes) to consider as a valid video
 MIN_VIDEO_SIZE_BYTES = 1024 * 1024  # 1 MB
 
+@lru_cache(maxsize=None)
+def base_run_task_kwargs():
+    """
+    run_task arguments that are fixed for the lifetime of the container
+    Built on first use rather than at import, so a missing environment variable
+    surfaces as the handler's 500 response instead of failing INIT
+    """
+    return {
+        'cluster': os.environ['CLUSTER_NAME'],
+        'taskDefinition': os.environ['TASK_DEFINITION'],
+        'capacityProviderStrategy': [
+            {
+                'capacityProvider': os.environ['CAPACITY_PROVIDER_NAME'],
+                'weight': 1,
+            },
+        ],
+        'count': 1,
+        'networkConfiguration': {
+            'awsvpcConfiguration': {
+                'subnets': os.environ['SUBNET_IDS'].split(','),
+                'assignPublicIp': os.environ['ASSIGN_PUBLIC_IP'],
+                'securityGroups': [os.environ['SECURITY_GROUP']]
+            }
+        },
+    }
+
+# Upper bound on concurrent S3 HEAD / ecs.run_task calls for multi-record S3 events
+MAX_CONCURRENT_REQUESTS = 10
+
+# Whether to HEAD each object to read a custom prompt from its user metadata.
+# When disabled, validation relies on the size in the S3 event and skips the HEAD.
+PROMPT_FROM_METADATA = os.environ.get('PROMPT_FROM_METADATA', 'true').lower() == 'true'
+
+@dataclass
+class RecordInfo:
+    """
+    An S3 record from the triggering event and the result of validating it
+    """
+    bucket: str
+    key: str
+    event_size: Optional[int] = None
+    is_valid: bool = False
+    reason: str = ''
+    file_info: Optional[dict] = None
+    prompt: Optional[str] = None
+
 def is_video_file(filename):
     """
     Check if the file has a supported video extension
     """
-    file_path = Path(filename.lower())
-    return file_path.suffix in SUPPORTED_VIDEO_EXTENSIONS
+    _, dot, ext = filename.rpartition('.')
+    return bool(dot) and ext.lower() in SUPPORTED_VIDEO_EXTENSIONS
 
-def validate_video_file(bucket, key):
+def validate_video_file(bucket, key, event_size=None, need_metadata=False):
     """
     Validate that the S3 object is a legitimate video file
+    Uses the object size from the S3 event when available and only issues a
+    HEAD request when the size is unknown or user metadata is needed.
     Returns: (is_valid, reason, file_info)
     """
     try:
-        # Get object metadata
-        response = s3.head_object(Bucket=bucket, Key=key)
-        
+        # Check file extension first; it is free and rules out most non-video uploads
+        if not is_video_file(key):
+            return False, f"Unsupported file extension. Supported: {', '.join('.' + ext for ext in sorted(SUPPORTED_VIDEO_EXTENSIONS))}", None
+
+        if event_size is not None and not need_metadata:
+            # The S3 event already carries the object size, so skip the HEAD
+            file_size = event_size
+            response = {'ContentLength': file_size}
+        else:
+            # Reject undersized uploads before paying for a HEAD round-trip
+            if event_size is not None and event_size < MIN_VIDEO_SIZE_BYTES:
+                return False, f"File too small ({event_size} bytes). Minimum size: {MIN_VIDEO_SIZE_BYTES} bytes", None
+
+            # Get object metadata
+            response = s3.head_object(Bucket=bucket, Key=key)
+            file_size = response.get('ContentLength', 0)
+
         # Check file size
-        file_size = response.get('ContentLength', 0)
         if file_size < MIN_VIDEO_SIZE_BYTES:
             return False, f"File too small ({file_size} bytes). Minimum size: {MIN_VIDEO_SIZE_BYTES} bytes", None
         
-        # Check file extension
-        if not is_video_file(key):
-            return False, f"Unsupported file extension. Supported: {', '.join(sorted(SUPPORTED_VIDEO_EXTENSIONS))}", None
-        
         # Check content type if available
         content_type = response.get('ContentType', '').lower()
         if content_type and not (content_type.startswith('video/') or content_type == 'application/octet-stream'):
@@ -64,130 +124,158 @@ def validate_video_file(bucket, key):
     except Exception as e:
         return False, f"Error validating file: {str(e)}", None
 
+def validate_record(info):
+    """
+    Validate a single S3 record and resolve the prompt to run it with
+    Returns: the same RecordInfo, populated with the validation result
+    """
+    logger.info(f"Processing file: s3://{info.bucket}/{info.key}")
+
+    # Validate that this is a video file
+    info.is_valid, info.reason, info.file_info = validate_video_file(
+        info.bucket, info.key, event_size=info.event_size, need_metadata=PROMPT_FROM_METADATA
+    )
+    if not info.is_valid:
+        return info
+
+    file_info = info.file_info
+    logger.info(f"Valid video file detected: {info.key} ({file_info['size']} bytes, {file_info['content_type']})")
+
+    # Extract custom prompt from metadata
+    custom_prompt = file_info['metadata'].get('prompt')
+
+    if custom_prompt:
+        logger.info(f"Using custom prompt from metadata: {custom_prompt}")
+    else:
+        # Use default prompt if no metadata provided
+        custom_prompt = os.environ.get('EVENT_PROMPT', '<image> Is there a person in the air jumping into the water?')
+        logger.info(f"Using default prompt: {custom_prompt}")
+
+    info.prompt = custom_prompt
+    return info
+
+def start_processing_task(bucket, key, prompt):
+    """
+    Start the ECS video processing task for a single S3 object
+    Returns: (task_arn, failure_reason)
+    """
+    # Start ECS task
+    response = ecs.run_task(
+        **base_run_task_kwargs(),
+        overrides={
+            'containerOverrides': [
+                {
+                    'name': 'video-processor',
+                    'environment': [
+                        {
+                            'name': 'S3_BUCKET',
+                            'value': bucket
+                        },
+                        {
+                            'name': 'S3_KEY',
+                            'value': key
+                        },
+                        {
+                            'name': 'EVENT_PROMPT',
+                            'value': prompt
+                        }
+                    ]
+                }
+            ]
+        }
+    )
+
+    # Check for failures from the API call and log them clearly
+    if response.get('failures'):
+        failure = response['failures'][0]
+        error_message = f"ECS task failed to start for {key}. Reason: {failure.get('reason')}. Detail: {failure.get('detail')}"
+        logger.error(error_message)
+        return None, f"ECS task failed: {failure.get('reason')}"
+
+    if not response.get('tasks'):
+        # This case should be rare if failures are handled, but it's good practice
+        error_message = f"ECS run_task did not return any tasks or failures for {key}"
+        logger.error(error_message)
+        return None, "ECS task creation returned no tasks"
+
+    return response['tasks'][0]['taskArn'], None
+
 def lambda_handler(event, context):
     """
     Lambda function triggered by S3 uploads to start ECS video processing task
     Only processes valid video files.
     """
 
-    # Log the entire event for debugging purposes to confirm invocation
-    logger.info(f"Lambda triggered. Event: {json.dumps(event)}")
+    # Log a compact summary to confirm invocation; the full event is only
+    # serialized when debug logging is enabled
+    logger.info("Lambda triggered. Records: %d", len(event.get('Records', [])))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Event: {json.dumps(event)}")
 
     processed_files = []
     skipped_files = []
 
     try:
-        # Parse S3 event
-        for record in event['Records']:
-            bucket = record['s3']['bucket']['name']
-            key = unquote_plus(record['s3']['object']['key'])
-            
-            logger.info(f"Processing file: s3://{bucket}/{key}")
-            
-            # Validate that this is a video file
-            is_valid, reason, file_info = validate_video_file(bucket, key)
-            
-            if not is_valid:
-                logger.warning(f"Skipping file {key}: {reason}")
-                skipped_files.append({
-                    'key': key,
-                    'reason': reason
-                })
-                continue
-            
-            logger.info(f"Valid video file detected: {key} ({file_info['size']} bytes, {file_info['content_type']})")
-            
-            # Extract custom prompt from metadata
-            metadata = file_info['metadata']
-            custom_prompt = metadata.get('prompt')
-            
-            if custom_prompt:
-                logger.info(f"Using custom prompt from metadata: {custom_prompt}")
-            else:
-                # Use default prompt if no metadata provided
-                custom_prompt = os.environ.get('EVENT_PROMPT', '<image> Is there a person in the air jumping into the water?')
-                logger.info(f"Using default prompt: {custom_prompt}")
-            
-            # Get environment variables
-            cluster = os.environ['CLUSTER_NAME']
-            task_definition = os.environ['TASK_DEFINITION']
-            subnet_ids = os.environ['SUBNET_IDS'].split(',')
-            security_group = os.environ['SECURITY_GROUP']
-            assign_public_ip = os.environ['ASSIGN_PUBLIC_IP']
-            capacity_provider_name = os.environ['CAPACITY_PROVIDER_NAME']
-
-            # Start ECS task
-            response = ecs.run_task(
-                cluster=cluster,
-                capacityProviderStrategy=[
-                    {
-                        'capacityProvider': capacity_provider_name,
-                        'weight': 1,
-                    },
-                ],
-                taskDefinition=task_definition,
-                count=1,
-                networkConfiguration={
-                    'awsvpcConfiguration': {
-                        'subnets': subnet_ids,
-                        'assignPublicIp': assign_public_ip,
-                        'securityGroups': [security_group]
-                    }
-                },
-                overrides={
-                    'containerOverrides': [
-                        {
-                            'name': 'video-processor',
-                            'environment': [
-                                {
-                                    'name': 'S3_BUCKET',
-                                    'value': bucket
-                                },
-                                {
-                                    'name': 'S3_KEY',
-                                    'value': key
-                                },
-                                {
-                                    'name': 'EVENT_PROMPT',
-                                    'value': custom_prompt
-                                }
-                            ]
-                        }
-                    ]
-                }
+        # Parse every S3 record up front
+        records = [
+            RecordInfo(
+                bucket=record['s3']['bucket']['name'],
+                key=unquote_plus(record['s3']['object']['key']),
+                event_size=record['s3']['object'].get('size'),
             )
-            
-            # Check for failures from the API call and log them clearly
-            if response.get('failures'):
-                failure = response['failures'][0]
-                error_message = f"ECS task failed to start for {key}. Reason: {failure.get('reason')}. Detail: {failure.get('detail')}"
-                logger.error(error_message)
-                # Continue processing other files instead of failing completely
-                skipped_files.append({
-                    'key': key,
-                    'reason': f"ECS task failed: {failure.get('reason')}"
-                })
-                continue
-
-            if not response.get('tasks'):
-                # This case should be rare if failures are handled, but it's good practice
-                error_message = f"ECS run_task did not return any tasks or failures for {key}"
-                logger.error(error_message)
-                skipped_files.append({
-                    'key': key,
-                    'reason': "ECS task creation returned no tasks"
-                })
-                continue
-
-            task_arn = response['tasks'][0]['taskArn']
-            logger.info(f"Started ECS task for {key}: {task_arn}")
-            
-            processed_files.append({
-                'key': key,
-                'task_arn': task_arn,
-                'file_size': file_info['size'],
-                'prompt': custom_prompt
-            })
+            for record in event['Records']
+        ]
+
+        if records:
+            with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(records))) as executor:
+                # Validate all records concurrently so their HEADs overlap;
+                # map() keeps the results in event order
+                pending_tasks = []
+                for info in executor.map(validate_record, records):
+                    if not info.is_valid:
+                        logger.warning(f"Skipping file {info.key}: {info.reason}")
+                        skipped_files.append({
+                            'key': info.key,
+                            'reason': info.reason
+                        })
+                        continue
+                    pending_tasks.append(info)
+
+                # Read the ECS settings here so a missing variable fails the whole
+                # invocation with a 500 rather than every record individually
+                if pending_tasks:
+                    base_run_task_kwargs()
+
+                # Start the ECS tasks concurrently; overrides differ per key so each
+                # record still needs its own run_task call. Results are collected in
+                # submission order so processed_files keeps the event order too
+                futures = [
+                    (executor.submit(start_processing_task, info.bucket, info.key, info.prompt), info)
+                    for info in pending_tasks
+                ]
+                for future, info in futures:
+                    try:
+                        task_arn, failure_reason = future.result()
+                    except Exception as e:
+                        logger.error(f"ECS run_task raised for {info.key}: {str(e)}")
+                        task_arn, failure_reason = None, f"ECS task failed: {str(e)}"
+
+                    if failure_reason:
+                        # Continue processing other files instead of failing completely
+                        skipped_files.append({
+                            'key': info.key,
+                            'reason': failure_reason
+                        })
+                        continue
+
+                    logger.info(f"Started ECS task for {info.key}: {task_arn}")
+
+                    processed_files.append({
+                        'key': info.key,
+                        'task_arn': task_arn,
+                        'file_size': info.file_info['size'],
+                        'prompt': info.prompt
+                    })
         
         # Prepare response
         response_body = {
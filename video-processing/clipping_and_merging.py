@@ -1,30 +1,118 @@
 import os
+import functools
+import shutil
 import subprocess
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 log = logging.getLogger(__name__)
 
+# Resolved once; an absolute executable path is also what lets subprocess use posix_spawn
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+
+# -------- ENCODER SELECTION --------
+# Hardware H.264 encoders in order of preference for hwaccel: "auto"
+HW_ENCODERS = {
+    "nvenc": "h264_nvenc",
+    "qsv": "h264_qsv",
+}
+
+# Hardware encoders that failed at runtime; later clips go straight to libx264
+_failed_encoders = set()
+
+@functools.lru_cache(maxsize=1)
+def available_encoders() -> frozenset:
+    """Lists the encoders compiled into the local FFmpeg build (probed once per process)."""
+    try:
+        output = subprocess.check_output([FFMPEG, "-hide_banner", "-encoders"], stderr=subprocess.DEVNULL).decode()
+    except Exception as e:
+        log.warning(f"Could not list FFmpeg encoders: {e}")
+        return frozenset()
+    return frozenset(line.split()[1] for line in output.splitlines() if len(line.split()) > 1)
+
+def select_video_encoder(hwaccel: str) -> str:
+    """Resolves the clipping 'hwaccel' setting to an FFmpeg video encoder name."""
+    if hwaccel == "none":
+        return "libx264"
+    candidates = list(HW_ENCODERS) if hwaccel == "auto" else [hwaccel]
+    for name in candidates:
+        encoder = HW_ENCODERS.get(name)
+        if encoder is None:
+            log.warning(f"Unknown hwaccel '{name}'. Using libx264.")
+            continue
+        if encoder in available_encoders() and encoder not in _failed_encoders:
+            return encoder
+    return "libx264"
+
+def _video_encoder_args(encoder, preset, crf) -> list:
+    """FFmpeg video codec arguments giving roughly equivalent quality for each encoder."""
+    if encoder == "h264_nvenc":
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", str(crf), "-b:v", "0"]
+    if encoder == "h264_qsv":
+        return ["-c:v", "h264_qsv", "-global_quality", str(crf)]
+    return ["-c:v", "libx264", "-preset", preset, "-crf", str(crf)]
+
+# -------- FFMPEG INVOCATION --------
+# Shared argv prefix for every FFmpeg call; -nostdin keeps parallel runs from competing for the terminal
+_BASE_ARGV = [FFMPEG, "-y", "-hide_banner", "-loglevel", "error", "-nostdin"]
+
+def _run_ffmpeg(cmd):
+    """Runs an FFmpeg command with its output hidden for a cleaner log."""
+    # No pipes are opened, so skipping the fd close loop is safe. Together with the absolute
+    # path in _BASE_ARGV this lets CPython spawn FFmpeg with posix_spawn instead of fork/exec
+    subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   close_fds=False, check=True)
+
+def _run_ffmpeg_with_fallback(build_cmd, encoder):
+    """Runs an FFmpeg command, retrying with libx264 if a hardware encoder fails."""
+    try:
+        _run_ffmpeg(build_cmd(encoder))
+    except subprocess.CalledProcessError:
+        if encoder == "libx264":
+            raise
+        log.warning(f"Encoding with {encoder} failed. Disabling it and retrying with libx264.")
+        _failed_encoders.add(encoder)
+        _run_ffmpeg(build_cmd("libx264"))
+
+
 # -------- FUNCTIONS --------
-def extract_clip(video_path, start, end, output_path, preset, crf, audio_bitrate):
+def extract_clip(video_path, start, end, output_path, preset, crf, audio_bitrate, stream_copy=False, encoder="libx264"):
     """Extracts a single clip from a video file using FFmpeg."""
-    cmd = [
-        "ffmpeg", "-y",
-        "-ss", str(start),
-        "-to", str(end),
-        "-i", str(video_path),
-        "-c:v", "libx264",
-        "-preset", preset,
-        "-crf", str(crf),
-        "-c:a", "aac",
-        "-b:a", audio_bitrate,
-        str(output_path)
-    ]
-    # Hide verbose FFmpeg output for a cleaner log
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    if stream_copy:
+        # Input seeking snaps to the nearest keyframe and the streams are
+        # remuxed as-is, so no decode or encode happens at all
+        cmd = [
+            *_BASE_ARGV,
+            "-ss", str(start),
+            "-i", str(video_path),
+            "-t", str(end - start),
+            "-c", "copy",
+            "-avoid_negative_ts", "make_zero",
+            str(output_path)
+        ]
+        _run_ffmpeg(cmd)
+        return
+
+    def build_cmd(enc):
+        # With NVENC, decode on the GPU too and keep frames in device memory
+        hw_input = ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"] if enc == "h264_nvenc" else []
+        return [
+            *_BASE_ARGV,
+            *hw_input,
+            "-ss", str(start),
+            "-to", str(end),
+            "-i", str(video_path),
+            *_video_encoder_args(enc, preset, crf),
+            "-c:a", "aac",
+            "-b:a", audio_bitrate,
+            str(output_path)
+        ]
+    _run_ffmpeg_with_fallback(build_cmd, encoder)
 
 
 def merge_clips(clip_paths, output_path):
@@ -36,16 +124,174 @@ def merge_clips(clip_paths, output_path):
             f.write(f"file '{clip.resolve()}'\n")
 
     cmd = [
-        "ffmpeg", "-y",
+        *_BASE_ARGV,
         "-f", "concat",
         "-safe", "0",
         "-i", str(list_file),
         "-c", "copy", # Copy streams without re-encoding for speed
         str(output_path)
     ]
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    _run_ffmpeg(cmd)
     list_file.unlink() # Clean up the temporary list file
 
+def coalesce_intervals(intervals, tolerance=1e-3) -> list:
+    """Merges overlapping or touching (start, end) intervals so no frame is encoded twice."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + tolerance:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+def has_audio_stream(video_path) -> bool:
+    """Checks whether a video file contains at least one audio stream."""
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "a:0", "-show_entries", "stream=index",
+        "-of", "csv=p=0", str(video_path)
+    ]
+    output = subprocess.check_output(cmd).decode().strip()
+    return bool(output)
+
+
+def _build_trim_filters(intervals, window_start, with_audio) -> list:
+    """Builds split/trim filter chains that route each interval to [vN] / [aN] pads."""
+    n = len(intervals)
+    filters = ["[0:v]split=" + str(n) + "".join(f"[vin{i}]" for i in range(n))]
+    if with_audio:
+        filters.append("[0:a]asplit=" + str(n) + "".join(f"[ain{i}]" for i in range(n)))
+    # Trim times are relative to the seek point, since input seeking resets timestamps to zero
+    for i, (start, end) in enumerate(intervals):
+        rel_start, rel_end = start - window_start, end - window_start
+        filters.append(f"[vin{i}]trim=start={rel_start:.3f}:end={rel_end:.3f},setpts=PTS-STARTPTS[v{i}]")
+        if with_audio:
+            filters.append(f"[ain{i}]atrim=start={rel_start:.3f}:end={rel_end:.3f},asetpts=PTS-STARTPTS[a{i}]")
+    return filters
+
+
+def extract_clips_single_pass(video_path, intervals, output_paths, preset, crf, audio_bitrate, encoder="libx264"):
+    """
+    Extracts every clip with one FFmpeg process that decodes the input only once.
+
+    The input is seeked to the first interval and read up to the last one; a
+    split/trim filtergraph then routes each interval to its own encoder.
+    """
+    window_start = min(start for start, _ in intervals)
+    window_end = max(end for _, end in intervals)
+    with_audio = has_audio_stream(video_path)
+    filters = _build_trim_filters(intervals, window_start, with_audio)
+
+    def build_cmd(enc):
+        # Decoded frames are filtered on the CPU, so only the encoder runs on hardware
+        cmd = [
+            *_BASE_ARGV,
+            "-ss", str(window_start),
+            "-t", str(window_end - window_start),
+            "-i", str(video_path),
+            "-filter_complex", ";".join(filters),
+        ]
+        for i, output_path in enumerate(output_paths):
+            cmd += ["-map", f"[v{i}]"]
+            if with_audio:
+                cmd += ["-map", f"[a{i}]", "-c:a", "aac", "-b:a", audio_bitrate]
+            cmd += [*_video_encoder_args(enc, preset, crf), str(output_path)]
+        return cmd
+    _run_ffmpeg_with_fallback(build_cmd, encoder)
+
+
+def extract_and_merge_single_pass(video_path, intervals, output_path, preset, crf, audio_bitrate, encoder="libx264"):
+    """
+    Cuts every interval and concatenates them straight into the final highlight reel.
+
+    Same single decode as extract_clips_single_pass, but the trimmed segments feed
+    a concat filter and one encoder, so no intermediate clip files are written.
+    """
+    window_start = min(start for start, _ in intervals)
+    window_end = max(end for _, end in intervals)
+    with_audio = has_audio_stream(video_path)
+    filters = _build_trim_filters(intervals, window_start, with_audio)
+
+    n = len(intervals)
+    if with_audio:
+        segments = "".join(f"[v{i}][a{i}]" for i in range(n))
+        filters.append(f"{segments}concat=n={n}:v=1:a=1[outv][outa]")
+    else:
+        segments = "".join(f"[v{i}]" for i in range(n))
+        filters.append(f"{segments}concat=n={n}:v=1:a=0[outv]")
+
+    def build_cmd(enc):
+        # Decoded frames are filtered on the CPU, so only the encoder runs on hardware
+        cmd = [
+            *_BASE_ARGV,
+            "-ss", str(window_start),
+            "-t", str(window_end - window_start),
+            "-i", str(video_path),
+            "-filter_complex", ";".join(filters),
+            "-map", "[outv]",
+        ]
+        if with_audio:
+            cmd += ["-map", "[outa]", "-c:a", "aac", "-b:a", audio_bitrate]
+        cmd += [*_video_encoder_args(enc, preset, crf), str(output_path)]
+        return cmd
+    _run_ffmpeg_with_fallback(build_cmd, encoder)
+
+
+def _extract_clips_per_clip(original_video_path, clip_jobs, clipping_config, encoder) -> list:
+    """Extracts each clip with its own FFmpeg process, several at a time."""
+    # FFmpeg runs out-of-process, so a thread pool is enough to keep several encodes in flight
+    max_workers = min(len(clip_jobs), clipping_config.get('max_parallel_clips', os.cpu_count() or 1))
+    log.info(f"Extracting {len(clip_jobs)} clips with up to {max_workers} parallel FFmpeg processes...")
+
+    extracted = [None] * len(clip_jobs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for job_idx, (start_time, end_time, clip_path) in enumerate(clip_jobs):
+            log.info(f"Extracting clip {job_idx+1}/{len(clip_jobs)}: {start_time:.2f}s to {end_time:.2f}s -> {clip_path.name}")
+            # Pass config values to the helper function
+            future = executor.submit(
+                extract_clip, original_video_path, start_time, end_time, clip_path,
+                preset=clipping_config['ffmpeg_preset'],
+                crf=clipping_config['crf_value'],
+                audio_bitrate=clipping_config['audio_bitrate'],
+                stream_copy=clipping_config.get('stream_copy', False),
+                encoder=encoder
+            )
+            futures[future] = job_idx
+
+        # Use tqdm for a clean progress bar
+        for future in tqdm(as_completed(futures), total=len(futures), desc="🎬 Extracting Clips", unit="clip"):
+            job_idx = futures[future]
+            clip_path = clip_jobs[job_idx][2]
+            try:
+                future.result()
+                extracted[job_idx] = clip_path
+            except Exception as e:
+                log.error(f"Failed to extract clip {clip_path.name}: {e}")
+
+    # Keep the original interval order for the concat list
+    return [clip_path for clip_path in extracted if clip_path is not None]
+
+
+def _extract_clips_single_pass(original_video_path, clip_jobs, clipping_config, encoder) -> list:
+    """Extracts all clips in one FFmpeg pass, falling back to per-clip extraction on failure."""
+    log.info(f"Extracting {len(clip_jobs)} clips in a single FFmpeg pass...")
+    try:
+        extract_clips_single_pass(
+            original_video_path,
+            [(start_time, end_time) for start_time, end_time, _ in clip_jobs],
+            [clip_path for _, _, clip_path in clip_jobs],
+            preset=clipping_config['ffmpeg_preset'],
+            crf=clipping_config['crf_value'],
+            audio_bitrate=clipping_config['audio_bitrate'],
+            encoder=encoder
+        )
+        return [clip_path for _, _, clip_path in clip_jobs]
+    except Exception as e:
+        log.error(f"Single-pass extraction failed ({e}). Falling back to per-clip extraction.")
+        return _extract_clips_per_clip(original_video_path, clip_jobs, clipping_config, encoder)
+
+
 def run_clipping(original_video_path: Path, predicted_intervals_csv_path: Path, output_dir: Path, clipping_config: dict) -> Path:
     """
     Orchestrates the video clipping and merging process.
@@ -60,7 +306,7 @@ def run_clipping(original_video_path: Path, predicted_intervals_csv_path: Path,
     """
     log.info(f"Starting clipping and merging for '{original_video_path.name}'...")
     try:
-        df = pd.read_csv(predicted_intervals_csv_path)
+        df = pd.read_csv(predicted_intervals_csv_path, engine="pyarrow")
     except FileNotFoundError:
         log.warning("Predicted intervals CSV not found. Skipping clipping.")
         return None
@@ -70,34 +316,60 @@ def run_clipping(original_video_path: Path, predicted_intervals_csv_path: Path,
         return None
 
     video_stem = original_video_path.stem
-    clips_dir = output_dir / "clips"
-    clips_dir.mkdir(exist_ok=True)
-    
-    clip_paths = []
-    # Use tqdm for a clean progress bar
-    for i, row in tqdm(df.iterrows(), total=len(df), desc="🎬 Extracting Clips", unit="clip"):
-        start_time = float(row["start"])
-        end_time = float(row["end"])
-        clip_filename = f"{video_stem}_clip_{i+1:03d}.mp4"
-        clip_path = clips_dir / clip_filename
-
-        log.info(f"Extracting clip {i+1}/{len(df)}: {start_time:.2f}s to {end_time:.2f}s -> {clip_filename}")
+    merged_filename = f"{video_stem}_highlights.mp4"
+    merged_path = output_dir / merged_filename
+    starts = df["start"].to_numpy(dtype=np.float64)
+    ends = df["end"].to_numpy(dtype=np.float64)
+    intervals = coalesce_intervals([(float(s), float(e)) for s, e in zip(starts, ends)])
+    if len(intervals) < len(df):
+        log.info(f"Coalesced {len(df)} overlapping intervals into {len(intervals)} clips.")
+
+    strategy = clipping_config.get('clip_strategy', 'per_clip')
+    if strategy in ('single_pass', 'fused') and clipping_config.get('stream_copy', False):
+        log.warning(f"stream_copy cannot be combined with {strategy} filtering. Using per-clip extraction.")
+        strategy = 'per_clip'
+    if strategy in ('single_pass', 'fused') and len(intervals) > clipping_config.get('single_pass_max_clips', 32):
+        # Every interval keeps its own filter branch (and, for single_pass, encoder) alive for the whole pass
+        log.info(f"{len(intervals)} clips exceeds single_pass_max_clips. Using per-clip extraction.")
+        strategy = 'per_clip'
+
+    encoder = select_video_encoder(clipping_config.get('hwaccel', 'auto'))
+    log.info(f"Using video encoder: {encoder}")
+
+    if strategy == 'fused':
+        log.info(f"Cutting and merging {len(intervals)} intervals into {merged_filename} in a single FFmpeg pass...")
         try:
-            # Pass config values to the helper function
-            extract_clip(
-                original_video_path, start_time, end_time, clip_path,
+            extract_and_merge_single_pass(
+                original_video_path, intervals, merged_path,
                 preset=clipping_config['ffmpeg_preset'],
                 crf=clipping_config['crf_value'],
-                audio_bitrate=clipping_config['audio_bitrate']
+                audio_bitrate=clipping_config['audio_bitrate'],
+                encoder=encoder
             )
-            clip_paths.append(clip_path)
+            log.info(f"Final highlight video saved to: {merged_path}")
+            return merged_path
         except Exception as e:
-            log.error(f"Failed to extract clip {clip_filename}: {e}")
+            log.error(f"Fused clipping failed ({e}). Falling back to per-clip extraction.")
+            strategy = 'per_clip'
 
-    if clip_paths:
-        merged_filename = f"{video_stem}_highlights.mp4"
-        merged_path = output_dir / merged_filename
+    clips_dir = output_dir / "clips"
+    clips_dir.mkdir(exist_ok=True)
+    clip_jobs = [
+        (start_time, end_time, clips_dir / f"{video_stem}_clip_{i+1:03d}.mp4")
+        for i, (start_time, end_time) in enumerate(intervals)
+    ]
 
+    if strategy == 'single_pass':
+        clip_paths = _extract_clips_single_pass(original_video_path, clip_jobs, clipping_config, encoder)
+    else:
+        clip_paths = _extract_clips_per_clip(original_video_path, clip_jobs, clipping_config, encoder)
+
+    if len(clip_paths) == 1:
+        # A single clip already is the highlight reel; no concat pass needed
+        clip_paths[0].replace(merged_path)
+        log.info(f"Final highlight video saved to: {merged_path}")
+        return merged_path
+    elif clip_paths:
         log.info(f"Merging {len(clip_paths)} clips into {merged_filename}...")
         merge_clips(clip_paths, merged_path)
         log.info(f"Final highlight video saved to: {merged_path}")
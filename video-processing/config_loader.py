@@ -4,6 +4,12 @@ import logging
 
 log = logging.getLogger(__name__)
 
+# Prefer the libyaml-backed loader; fall back to the pure-Python one if PyYAML was built without it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 def load_config(config_path="config.yaml"):
     """Loads the YAML configuration file."""
     path = Path(config_path)
@@ -12,7 +18,7 @@ def load_config(config_path="config.yaml"):
         raise FileNotFoundError(f"Configuration file not found at: {config_path}")
     
     with open(path, 'r') as f:
-        config = yaml.safe_load(f)
+        config = yaml.load(f, Loader=SafeLoader)
     log.info("Configuration file loaded successfully.")
     return config
 
@@ -1,7 +1,10 @@
+import re
 import subprocess
 from pathlib import Path
+import numpy as np
 import pandas as pd
-import cv2
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import logging
 
 log = logging.getLogger(__name__)
@@ -20,38 +23,36 @@ def get_original_fps(video_path: Path) -> float:
     log.info(f"Detected original FPS: {fps:.3f}")
     return fps
 
-# -------- TIMESTAMP MAPPING --------
-def generate_timestamp_mapping(downsampled_video_path: Path, orig_fps: float, target_fps: float) -> pd.DataFrame:
-    """Generates a DataFrame mapping frames in the downsampled video to original timestamps."""
-    cap_down = cv2.VideoCapture(str(downsampled_video_path))
-    downsampled_total_frames = int(cap_down.get(cv2.CAP_PROP_FRAME_COUNT))
-    cap_down.release()
-
-    stride = round(orig_fps / target_fps)
-    rows = []
-    for i in range(downsampled_total_frames):
-        original_frame_number = i * stride
-        original_timestamp = original_frame_number / orig_fps
-        rows.append({
-            "inference_frame_number": i,
-            "original_frame_number": original_frame_number,
-            "original_timestamp_sec": round(original_timestamp, 3)
-        })
-
-    return pd.DataFrame(rows)
-
 # -------- DOWNSAMPLING --------
-def downsample_video(input_path: Path, output_path: Path, target_fps: int):
-    # This function is now just a direct call, no changes needed here
+# showinfo logs one line per frame leaving the fps filter. It runs after fps, so pts_time is the
+# frame's slot on the fps output grid (about n / target_fps from the start), not the exact PTS of the
+# source frame fps picked for it; the two differ by up to half an output frame interval
+SHOWINFO_PTS_TIME = re.compile(r"\bn:\s*\d+\s+pts:\s*-?\d+\s+pts_time:(-?\d+(?:\.\d+)?)")
+
+def downsample_video(input_path: Path, output_path: Path, target_fps: int) -> np.ndarray:
+    """Downsamples the video and returns the output timestamp (seconds) of every frame on the fps grid."""
     cmd = [
-        "ffmpeg",
+        "ffmpeg", "-hide_banner", "-nostats",
         "-y", "-i", str(input_path),
-        "-filter:v", f"fps={target_fps}",
+        "-filter:v", f"fps={target_fps},showinfo",
         "-vsync", "vfr", "-start_at_zero",
         "-c:v", "libx264", "-preset", "fast", "-crf", "28", "-an",
         str(output_path)
     ]
-    subprocess.run(cmd, check=True)
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors="replace")
+    if result.returncode != 0:
+        log.error("FFmpeg downsampling failed:\n%s", "\n".join(result.stderr.splitlines()[-20:]))
+        raise subprocess.CalledProcessError(result.returncode, cmd, stderr=result.stderr)
+    return np.array(SHOWINFO_PTS_TIME.findall(result.stderr), dtype=np.float64)
+
+# -------- TIMESTAMP MAPPING --------
+def build_timestamp_mapping(pts_times: np.ndarray, orig_fps: float) -> pd.DataFrame:
+    """Builds a DataFrame mapping frames in the downsampled video to original timestamps."""
+    return pd.DataFrame({
+        "inference_frame_number": np.arange(len(pts_times), dtype=np.int64),
+        "original_frame_number": np.round(pts_times * orig_fps).astype(np.int64),
+        "original_timestamp_sec": np.round(pts_times, 3)
+    })
 
 # The function signature now requires target_fps instead of having a default.
 def run_downsampling(input_video_path: Path, output_dir: Path, target_fps: int) -> tuple[Path, Path]:
@@ -62,13 +63,14 @@ def run_downsampling(input_video_path: Path, output_dir: Path, target_fps: int)
     log.info(f"Starting downsampling for '{video_stem}' to {target_fps} FPS...")
 
     downsampled_video_path = output_dir / f"{video_stem}_{target_fps}fps.mp4"
-    downsample_video(input_video_path, downsampled_video_path, target_fps)
+    pts_times = downsample_video(input_video_path, downsampled_video_path, target_fps)
     log.info(f"Downsampled video saved to: {downsampled_video_path}")
 
     orig_fps = get_original_fps(input_video_path)
-    timestamp_df = generate_timestamp_mapping(downsampled_video_path, orig_fps, target_fps)
+    timestamp_df = build_timestamp_mapping(pts_times, orig_fps)
     timestamps_csv_path = output_dir / f"{video_stem}_timestamps.csv"
-    timestamp_df.to_csv(timestamps_csv_path, index=False)
+    # pandas' Python CSV writer is slow for long videos; pyarrow's columnar writer is not
+    pa_csv.write_csv(pa.Table.from_pandas(timestamp_df, preserve_index=False), str(timestamps_csv_path))
     log.info(f"Timestamp mapping saved to: {timestamps_csv_path}")
 
     return downsampled_video_path, timestamps_csv_path
@@ -4,15 +4,18 @@ import logging
 import tempfile
 import traceback
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 import pandas as pd
+from tqdm import tqdm
 
 # Import the refactored processing functions
 from downsample_videos import run_downsampling
-from run_inference_and_postprocess import run_inference
+from run_inference_and_postprocess import run_inference, load_model
 from clipping_and_merging import run_clipping
 from config_loader import config # Import the loaded config
 
@@ -24,6 +27,14 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
+# Source videos are often multi-GB; fetch them as concurrent byte-range GETs
+DOWNLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=32 * 1024 * 1024,
+    max_concurrency=16,
+    use_threads=True,
+)
+
 # --- Main Orchestrator ---
 def main():
     """
@@ -56,7 +67,27 @@ def main():
             original_video_filename = Path(s3_key).name
             local_video_path = temp_dir / original_video_filename
             log.info(f"Downloading video to {local_video_path}...")
-            s3_client.download_file(s3_bucket, s3_key, str(local_video_path))
+            download_start = time.time()
+            with tqdm(desc="⬇️ Downloading Video", unit="B", unit_scale=True) as pbar:
+                # Ranged GETs run in parallel threads; the callback lands from those threads
+                s3_client.download_file(
+                    s3_bucket, s3_key, str(local_video_path),
+                    Config=DOWNLOAD_TRANSFER_CONFIG, Callback=pbar.update
+                )
+            log.info(f"Downloaded {local_video_path.stat().st_size / (1 << 20):.1f} MiB in {time.time() - download_start:.2f}s")
+
+            # Load the model while FFmpeg downsamples; loading is disk/PCIe-bound and
+            # downsampling is CPU-bound, so the two overlap instead of running back to back
+            model_future = None
+            if not skip_inference_test:
+                model_loader = ThreadPoolExecutor(max_workers=1)
+                model_future = model_loader.submit(
+                    load_model,
+                    config['inference']['model_id'],
+                    config['inference'].get('quantization', 'none'),
+                    config['inference'].get('compile_vision_tower', False),
+                )
+                model_loader.shutdown(wait=False) # The worker exits once the load finishes
 
             # --- STAGE 1: DOWNSAMPLING ---
             stage1_start = time.time()
@@ -86,7 +117,9 @@ def main():
                     inference_config=config['inference'],
                     post_proc_config=config['post_processing'],
                     # FIX: Added the missing target_fps argument
-                    target_fps=config['downsampling']['target_fps']
+                    target_fps=config['downsampling']['target_fps'],
+                    # Blocks only if the model is still loading
+                    model_and_processor=model_future.result()
                 )
             log.info(f"--- Stage 2 (Inference) completed in {time.time() - stage2_start:.2f}s ---")
 
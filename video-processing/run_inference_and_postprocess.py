@@ -1,229 +1,675 @@
 import os
+import json
 import time
-import subprocess
 import logging
+import numpy as np
 import pandas as pd
 import torch
 import torch.nn.functional as F
 import cv2
 from pathlib import Path
 from PIL import Image
-from transformers import AutoProcessor, PaliGemmaForConditionalGeneration
+from transformers import AutoProcessor, BitsAndBytesConfig, PaliGemmaForConditionalGeneration
+import queue
 import threading
+import pynvml
 from tqdm import tqdm
 
+# NVDEC decoding goes through torchaudio's FFmpeg bindings; without them frames are decoded by OpenCV on the CPU
+try:
+    from torchaudio.io import StreamReader
+except ImportError:
+    StreamReader = None
+
 log = logging.getLogger(__name__)
 
 # --- Environment and Device Setup ---
-os.environ["TORCHDYNAMO_DISABLE"] = "1"
 torch.cuda.empty_cache()
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 log.info(f"Using device: {device}")
 
 
 # --- Model Loading ---
-def load_model(model_id: str):
+def _quantization_config(quantization: str):
+    """Maps the config's quantization setting to a bitsandbytes config; activations stay in FP16."""
+    if quantization == "none":
+        return None
+    if quantization == "int8":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    if quantization == "int4":
+        return BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type="nf4", bnb_4bit_compute_dtype=torch.float16)
+    raise ValueError(f"Unknown quantization '{quantization}', expected 'none', 'int8' or 'int4'")
+
+def load_model(model_id: str, quantization: str = "none", compile_vision_tower: bool = False):
     """Loads the PaliGemma model and processor from the specified model_id."""
-    log.info(f"Loading model '{model_id}' to device '{device}'...")
+    log.info(f"Loading model '{model_id}' to device '{device}' (quantization: {quantization})...")
     start_time = time.time()
+    # Frame batches always have the same shape, so let cuDNN pick the fastest conv algorithms once
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")
     processor = AutoProcessor.from_pretrained(model_id)
+    quantization_config = _quantization_config(quantization)
     model = PaliGemmaForConditionalGeneration.from_pretrained(
         model_id,
         torch_dtype=torch.float16,
         low_cpu_mem_usage=True,
-    ).to(device)
+        attn_implementation="sdpa",
+        quantization_config=quantization_config,
+        # Quantized weights are placed by bitsandbytes at load time and cannot be moved with .to()
+        device_map={"": device} if quantization_config is not None else None,
+    )
+    if quantization_config is None:
+        model = model.to(device)
     model.eval()
+    # The SigLIP patch embedding is a conv; pixel_values arrive channels-last from the NHWC frames
+    model.vision_tower.to(memory_format=torch.channels_last)
+    # The vision tower always sees (B, 3, 224, 224), so Inductor can fuse it and replay it as a
+    # CUDA graph; bitsandbytes layers do not trace, so quantized models stay eager
+    if compile_vision_tower and device.type == "cuda" and quantization_config is None:
+        # Compilation is lazy; _run_inference_on_video falls back to eager if the first call fails
+        model.model.vision_tower = torch.compile(model.vision_tower, mode="reduce-overhead", fullgraph=True, dynamic=False)
     log.info(f"Model loaded and ready in {time.time() - start_time:.2f}s.")
     return model, processor
 
+def _use_eager_vision_tower(model) -> bool:
+    """Swaps a compiled vision tower back to its eager module; returns False if it was not compiled."""
+    vision_tower = model.model.vision_tower
+    if not hasattr(vision_tower, "_orig_mod"):
+        return False
+    model.model.vision_tower = vision_tower._orig_mod
+    return True
+
 
 # --- GPU Utilization Polling ---
-polling = False
-gpu_utils = []
-def poll_gpu_utilization(interval=0.5):
-    """Polls GPU utilization at a given interval."""
-    global polling, gpu_utils
-    while polling:
+def poll_gpu_utilization(stop_event: threading.Event, samples: list, interval=1.0):
+    """Appends a GPU utilization sample to samples every interval until stop_event is set."""
+    # NVML is queried in-process; spawning nvidia-smi per sample cost tens of ms of CPU each time
+    try:
+        pynvml.nvmlInit()
+        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+    except pynvml.NVMLError as e:
+        log.warning(f"NVML unavailable, GPU utilization will not be recorded: {e}")
+        return
+    try:
+        # wait() returns as soon as the event is set, so shutdown does not sit out a full interval
+        while not stop_event.wait(interval):
+            try:
+                samples.append(pynvml.nvmlDeviceGetUtilizationRates(handle).gpu)
+            except pynvml.NVMLError:
+                samples.append(0) # Append 0 if the query fails
+    finally:
+        pynvml.nvmlShutdown()
+
+
+# --- GPU Preprocessing ---
+def _prompt_inputs(processor, prompt: str) -> dict:
+    """Tokenizes the prompt once per video; it is identical for every frame."""
+    # The processor only expands the <image> tokens when it is given an image
+    size = processor.image_processor.size
+    dummy_image = Image.new("RGB", (size["width"], size["height"]))
+    inputs = processor(images=dummy_image, text=prompt, return_tensors="pt")
+    inputs.pop("pixel_values")
+    return {name: tensor.to(device) for name, tensor in inputs.items()}
+
+def _normalization_constants(image_processor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Folds rescaling and mean/std normalization into one (1, 3, 1, 1) scale and shift, built once per video."""
+    mean = torch.tensor(image_processor.image_mean, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(image_processor.image_std, device=device).view(1, 3, 1, 1)
+    return image_processor.rescale_factor / std, -mean / std
+
+def _preprocess_frames(frames: torch.Tensor, image_processor, scale: torch.Tensor, shift: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """Resizes and normalizes a (B, H, W, 3) uint8 RGB batch on the device, as the HF image processor would."""
+    size = image_processor.size
+    # Resize in the model's half precision on the GPU; CPU kernels need float32
+    pixels = frames.permute(0, 3, 1, 2).to(dtype if frames.is_cuda else torch.float32)
+    pixels = F.interpolate(pixels, size=(size["height"], size["width"]), mode="bicubic", antialias=True)
+    pixels = pixels.clamp_(0, 255)
+    return torch.addcmul(shift, pixels, scale).to(dtype)
+
+
+# --- Frame Decoding ---
+# Double buffering: one batch is decoded into host memory while the other is on the GPU
+NUM_HOST_BUFFERS = 2
+# Frames are compared for the motion prefilter as small grayscale thumbnails
+PREFILTER_SIZE = (32, 32)
+# Decoded frames are area-downscaled to at most this multiple of the model's input size before
+# batching, so full-resolution frames never fill the pinned buffers, cross PCIe or get converted
+# to floats on the GPU; the bicubic resize on the device still has enough pixels to antialias from
+DECODE_SIZE_FACTOR = 2
+
+def _decode_size(width: int, height: int, max_size: tuple) -> tuple:
+    """The (width, height) a cropped frame is downscaled to before batching; frames are never upscaled."""
+    return min(width, max_size[0]), min(height, max_size[1])
+
+def _iter_frame_batches(cap, crop_coords: dict, batch_size: int, max_size: tuple, motion_threshold: float = None):
+    """
+    Yields (frames, frame_numbers, skipped_frame_numbers) batches of cropped (B, H, W, 3) uint8 RGB frames on the device.
+
+    Frames are cropped and then area-downscaled to fit within max_size (width, height).
+
+    A background thread decodes and crops frames into pinned host buffers while the
+    previous batch is being processed, and each host-to-device copy runs on its own
+    CUDA stream so it overlaps with compute.
+
+    With a motion_threshold, frames whose mean absolute grayscale difference from the last
+    kept frame is below it never enter a batch and are reported in skipped_frame_numbers.
+    The last item may then have frames set to None if only skipped frames were left.
+    """
+    use_cuda = device.type == "cuda"
+    copy_stream = torch.cuda.Stream() if use_cuda else None
+    filled_batches = queue.Queue(maxsize=NUM_HOST_BUFFERS)
+    # (buffer, event) pairs; the event marks when the GPU has finished copying out of the buffer
+    free_buffers = queue.Queue()
+    stop_decoding = threading.Event()
+
+    def decode():
+        host_buf, count, frame_numbers, skipped = None, 0, [], []
+        last_kept = None
+        buffers_allocated = False
+        frame_idx = 0
+        try:
+            while not stop_decoding.is_set():
+                success, frame = cap.read()
+                if not success:
+                    break
+
+                h, w, _ = frame.shape
+                # Use crop coordinates from config
+                crop_start = int(w * crop_coords['start'])
+                crop_end = int(w * crop_coords['end'])
+                if not buffers_allocated:
+                    decode_w, decode_h = _decode_size(crop_end - crop_start, h, max_size)
+                    resize = (decode_w, decode_h) != (crop_end - crop_start, h)
+                    for _ in range(NUM_HOST_BUFFERS):
+                        buf = torch.empty((batch_size, decode_h, decode_w, 3), dtype=torch.uint8, pin_memory=use_cuda)
+                        free_buffers.put((buf, None))
+                    buffers_allocated = True
+
+                if motion_threshold is not None:
+                    thumbnail = cv2.cvtColor(
+                        cv2.resize(frame[:, crop_start:crop_end], PREFILTER_SIZE, interpolation=cv2.INTER_AREA),
+                        cv2.COLOR_BGR2GRAY,
+                    )
+                    if last_kept is not None and cv2.absdiff(thumbnail, last_kept).mean() < motion_threshold:
+                        skipped.append(frame_idx)
+                        frame_idx += 1
+                        continue
+                    last_kept = thumbnail
+
+                if host_buf is None:
+                    entry = free_buffers.get()
+                    if entry is None:
+                        return
+                    host_buf, copy_done = entry
+                    if copy_done is not None:
+                        copy_done.synchronize()
+                    host_frames = host_buf.numpy()
+
+                # Crop and downscale before the color conversion and write straight into the pinned buffer
+                cropped = frame[:, crop_start:crop_end]
+                if resize:
+                    cropped = cv2.resize(cropped, (decode_w, decode_h), interpolation=cv2.INTER_AREA)
+                cv2.cvtColor(cropped, cv2.COLOR_BGR2RGB, dst=host_frames[count])
+                frame_numbers.append(frame_idx)
+                count += 1
+                frame_idx += 1
+
+                # Use batch_size from config
+                if count == batch_size:
+                    filled_batches.put((host_buf, count, frame_numbers, skipped))
+                    host_buf, count, frame_numbers, skipped = None, 0, [], []
+
+            if count or skipped:
+                filled_batches.put((host_buf, count, frame_numbers, skipped)) # The final partial batch
+        except Exception as e:
+            filled_batches.put(e)
+        finally:
+            filled_batches.put(None)
+
+    decoder = threading.Thread(target=decode, name="frame-decoder", daemon=True)
+    decoder.start()
+    try:
+        while True:
+            item = filled_batches.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            host_buf, count, frame_numbers, skipped = item
+
+            if not count:
+                yield None, frame_numbers, skipped
+            elif use_cuda:
+                with torch.cuda.stream(copy_stream):
+                    frames = host_buf[:count].to(device, non_blocking=True)
+                    copy_done = torch.cuda.Event()
+                    copy_done.record(copy_stream)
+                # The decoder may refill the buffer as soon as the copy has landed
+                free_buffers.put((host_buf, copy_done))
+                torch.cuda.current_stream().wait_stream(copy_stream)
+                frames.record_stream(torch.cuda.current_stream())
+                yield frames, frame_numbers, skipped
+            else:
+                yield host_buf[:count], frame_numbers, skipped
+                free_buffers.put((host_buf, None))
+    finally:
+        stop_decoding.set()
+        free_buffers.put(None) # Wake the decoder if it is waiting for a buffer
+        while decoder.is_alive():
+            try:
+                filled_batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+# --- NVDEC Frame Decoding ---
+# BT.601 limited-range YUV -> RGB, the colorspace libx264 writes for the downsampled video
+YUV_OFFSET = (16.0, 128.0, 128.0)
+YUV_TO_RGB = (
+    (1.164, 0.000, 1.596),
+    (1.164, -0.392, -0.813),
+    (1.164, 2.017, 0.000),
+)
+
+def _open_nvdec_reader(video_path: Path, batch_size: int, hwaccel: str):
+    """Opens an NVDEC-backed reader for hwaccel "auto" or "nvdec", or returns None to decode on the CPU."""
+    if hwaccel == "none" or device.type != "cuda":
+        return None
+    if StreamReader is None:
+        log.warning("torchaudio is not installed. Decoding frames on the CPU.")
+        return None
+    try:
+        reader = StreamReader(str(video_path))
+        reader.add_video_stream(batch_size, decoder="h264_cuvid", hw_accel=f"cuda:{torch.cuda.current_device()}")
+    except Exception as e:
+        log.warning(f"NVDEC decoding unavailable ({e}). Decoding frames on the CPU.")
+        return None
+    return reader
+
+def _iter_frame_batches_nvdec(reader, crop_coords: dict, max_size: tuple):
+    """
+    Yields (frames, frame_numbers) batches of cropped (B, H, W, 3) uint8 RGB frames decoded by NVDEC.
+
+    Frames are decoded straight into device memory and cropped, downscaled to fit within
+    max_size (width, height) and color-converted there, so nothing crosses PCIe on the way to the model.
+    """
+    offset = torch.tensor(YUV_OFFSET, device=device)
+    yuv_to_rgb = torch.tensor(YUV_TO_RGB, device=device).T
+    frame_idx = 0
+    for (chunk,) in reader.stream():
+        # Each chunk is a (B, 3, H, W) YUV444 uint8 tensor on the device
+        w = chunk.shape[-1]
+        # Use crop coordinates from config
+        yuv = chunk[..., int(w * crop_coords['start']):int(w * crop_coords['end'])]
+        decode_w, decode_h = _decode_size(yuv.shape[-1], yuv.shape[-2], max_size)
+        if (decode_w, decode_h) != (yuv.shape[-1], yuv.shape[-2]):
+            yuv = F.interpolate(yuv.half(), size=(decode_h, decode_w), mode="area")
+        rgb = (yuv.permute(0, 2, 3, 1).float() - offset) @ yuv_to_rgb
+        frames = rgb.clamp_(0, 255).round_().to(torch.uint8)
+        yield frames, list(range(frame_idx, frame_idx + len(frames))), []
+        frame_idx += len(frames)
+
+def _iter_frame_batches_nvdec_with_fallback(reader, video_path: Path, crop_coords: dict, batch_size: int, max_size: tuple):
+    """Like _iter_frame_batches_nvdec, but finishes the video with OpenCV if NVDEC fails while streaming."""
+    frame_idx = 0
+    try:
+        for frames, frame_numbers, skipped in _iter_frame_batches_nvdec(reader, crop_coords, max_size):
+            yield frames, frame_numbers, skipped
+            frame_idx = frame_numbers[-1] + 1
+        return
+    except Exception as e:
+        log.warning(f"NVDEC decoding failed after {frame_idx} frames ({e}). Decoding the rest on the CPU.")
+
+    cap = cv2.VideoCapture(str(video_path))
+    assert cap.isOpened(), f"Cannot open video: {video_path}"
+    try:
+        # Skip the frames NVDEC already delivered; grab() does not decode them into images
+        for _ in range(frame_idx):
+            cap.grab()
+        for frames, frame_numbers, skipped in _iter_frame_batches(cap, crop_coords, batch_size, max_size):
+            yield frames, [n + frame_idx for n in frame_numbers], [n + frame_idx for n in skipped]
+    finally:
+        cap.release()
+
+
+# --- Batch Size Tuning ---
+BATCH_SIZE_CANDIDATES = (4, 8, 16, 32, 64)
+# Used when batch_size is "auto" but there is no GPU to tune against
+DEFAULT_BATCH_SIZE = 16
+# Batch sizes whose peak memory exceeds this fraction of the card are rejected to leave an OOM margin
+MAX_MEMORY_FRACTION = 0.95
+# Relative to the working directory by default. Each ECS task starts from a fresh container,
+# so there the cache only survives between runs if this points at mounted persistent storage
+BATCH_SIZE_CACHE_PATH = Path(os.environ.get("BATCH_SIZE_CACHE_PATH", "batch_size_cache.json"))
+
+def _tune_batch_size(generate, frame_shape: tuple, cache_key: str, trials: int = 3) -> int:
+    """
+    Picks the candidate batch size with the highest frames/s on this GPU.
+
+    Each candidate runs one untimed batch and then `trials` timed batches of dummy frames
+    of frame_shape, which should match the (H, W, 3) frames the decoder will really deliver.
+    The sweep stops at the first size that runs out of memory or gets too close to it.
+    The result is cached per cache_key in a JSON sidecar so later runs skip the sweep; if even
+    the smallest candidate does not fit, the smallest is returned and nothing is cached.
+    """
+    try:
+        cache = json.loads(BATCH_SIZE_CACHE_PATH.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = {}
+    if cache_key in cache:
+        log.info(f"Using cached batch size {cache[cache_key]} for {cache_key}")
+        return cache[cache_key]
+
+    total_memory = torch.cuda.get_device_properties(device).total_memory
+    best_batch_size, best_fps = None, 0.0
+    for batch_size in BATCH_SIZE_CANDIDATES:
+        frames = torch.zeros((batch_size, *frame_shape), dtype=torch.uint8, device=device)
+        torch.cuda.reset_peak_memory_stats(device)
         try:
-            output = subprocess.check_output(
-                ['nvidia-smi', '--query-gpu=utilization.gpu', '--format=csv,noheader,nounits'],
-                encoding='utf-8'
-            )
-            util = int(output.strip())
-            gpu_utils.append(util)
-        except Exception:
-            gpu_utils.append(0) # Append 0 if nvidia-smi fails
-        time.sleep(interval)
+            with torch.inference_mode():
+                generate(frames)
+                latencies = []
+                for _ in range(trials):
+                    torch.cuda.synchronize(device)
+                    start = time.perf_counter()
+                    generate(frames)
+                    torch.cuda.synchronize(device)
+                    latencies.append(time.perf_counter() - start)
+        except torch.cuda.OutOfMemoryError:
+            log.info(f"Batch size {batch_size} ran out of memory.")
+            break
+        finally:
+            del frames
+            torch.cuda.empty_cache()
+
+        memory_fraction = torch.cuda.max_memory_allocated(device) / total_memory
+        if memory_fraction > MAX_MEMORY_FRACTION:
+            log.info(f"Batch size {batch_size} used {memory_fraction:.0%} of GPU memory.")
+            break
+        fps = batch_size / sorted(latencies)[len(latencies) // 2]
+        log.info(f"Batch size {batch_size}: {fps:.1f} frames/s, {memory_fraction:.0%} of GPU memory")
+        if fps > best_fps:
+            best_batch_size, best_fps = batch_size, fps
+
+    if best_batch_size is None:
+        # Not cached, so the sweep runs again once memory is free (e.g. on a larger GPU or a smaller model)
+        log.warning(f"No candidate batch size fit in GPU memory for {cache_key}; using {BATCH_SIZE_CANDIDATES[0]} uncached.")
+        return BATCH_SIZE_CANDIDATES[0]
+    log.info(f"Selected batch size {best_batch_size} for {cache_key}")
+    cache[cache_key] = best_batch_size
+    BATCH_SIZE_CACHE_PATH.write_text(json.dumps(cache, indent=2))
+    return best_batch_size
 
 
 # --- Core Inference Function ---
 def _run_inference_on_video(
-    model, processor, video_path: Path, timestamps_df: pd.DataFrame, 
-    prompt: str, batch_size: int, crop_coords: dict, max_new_tokens: int, target_fps: int
+    model, processor, video_path: Path, timestamp_map: dict, 
+    prompt: str, batch_size: int, crop_coords: dict, max_new_tokens: int, target_fps: int,
+    hwaccel: str = "none", motion_threshold: float = None, decision: str = "generate",
+    quantization: str = "none"
 ) -> pd.DataFrame:
     """Helper function to run the core inference loop on a video file."""
-    inference_start_time = time.time()
-    cap = cv2.VideoCapture(str(video_path))
-    assert cap.isOpened(), f"Cannot open video: {video_path}"
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    prompt_inputs = _prompt_inputs(processor, prompt)
+    scale, shift = _normalization_constants(processor.image_processor)
+    if decision not in ("generate", "logits"):
+        raise ValueError(f"Unknown decision '{decision}', expected 'generate' or 'logits'")
+    if decision == "logits":
+        # The answer is the first token after the prompt, so "yes" and "no" are read off its logits
+        yes_no_ids = [processor.tokenizer.convert_tokens_to_ids(answer) for answer in ("yes", "no")]
+        # convert_tokens_to_ids maps pieces missing from the vocabulary to the unknown token
+        if processor.tokenizer.unk_token_id in yes_no_ids:
+            raise ValueError(f"The tokenizer has no single 'yes'/'no' tokens (got ids {yes_no_ids}); use decision 'generate'")
+
+    def model_inputs(frames):
+        """Builds the model inputs for a (B, H, W, 3) uint8 frame batch."""
+        # Only the cropped uint8 frames cross PCIe; resizing and normalization run on the GPU
+        pixel_values = _preprocess_frames(frames, processor.image_processor, scale, shift, model.dtype)
+        # expand() shares the single tokenized prompt across the batch without copying it
+        inputs = {name: tensor.expand(len(frames), -1) for name, tensor in prompt_inputs.items()}
+        return dict(inputs, pixel_values=pixel_values)
+
+    def forward(frames):
+        """Runs a single forward pass, keeping only the logits for the next token."""
+        return model(**model_inputs(frames), use_cache=False, logits_to_keep=1)
+
+    def generate(frames):
+        """Runs the model on a (B, H, W, 3) uint8 frame batch."""
+        return model.generate(
+            **model_inputs(frames),
+            max_new_tokens=max_new_tokens, # Use config value
+            output_scores=True,
+            return_dict_in_generate=True,
+            # Greedy decoding with a preallocated KV cache; generate() reuses the static cache
+            # across batches of the same size instead of growing it on every decode step
+            do_sample=False,
+            num_beams=1,
+            use_cache=True,
+            cache_implementation="static",
+            pad_token_id=processor.tokenizer.pad_token_id,
+            # Only the vision tower is compiled; keep generate() from compiling the decoder for the static cache
+            disable_compile=True,
+        )
+
+    run_batch = forward if decision == "logits" else generate
+    size = processor.image_processor.size
+    max_decode_size = (DECODE_SIZE_FACTOR * size["width"], DECODE_SIZE_FACTOR * size["height"])
+    # The shape of the cropped, downscaled frames the decoder will deliver, so tuning and warmup see the real workload
+    probe = cv2.VideoCapture(str(video_path))
+    assert probe.isOpened(), f"Cannot open video: {video_path}"
+    source_w, source_h = int(probe.get(cv2.CAP_PROP_FRAME_WIDTH)), int(probe.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    probe.release()
+    crop_w = int(source_w * crop_coords['end']) - int(source_w * crop_coords['start'])
+    decode_w, decode_h = _decode_size(crop_w, source_h, max_decode_size)
+    frame_shape = (decode_h, decode_w, 3)
+
+    def warm_up(batch_size):
+        """Tunes the batch size if requested and runs the warmup batches; returns the batch size to use."""
+        if batch_size == "auto":
+            if device.type == "cuda":
+                # Quantization and vision tower compilation both change activation memory and speed,
+                # and the eager fallback below re-tunes under its own key
+                compiled = hasattr(model.model.vision_tower, "_orig_mod")
+                cache_key = (
+                    f"{model.name_or_path}|{model.dtype}|{quantization}|compiled={compiled}|{decision}|"
+                    f"{max_new_tokens}|{decode_w}x{decode_h}|{torch.cuda.get_device_name(device)}"
+                )
+                batch_size = _tune_batch_size(run_batch, frame_shape, cache_key)
+            else:
+                batch_size = DEFAULT_BATCH_SIZE
+
+        # Run two dummy batches first so vision tower compilation, CUDA graph capture, cuDNN autotuning
+        # and CUDA allocator growth happen before timing starts rather than on the first real batches
+        with torch.inference_mode():
+            for _ in range(2):
+                run_batch(torch.zeros((batch_size, *frame_shape), dtype=torch.uint8, device=device))
+        return batch_size
+
+    try:
+        batch_size = warm_up(batch_size)
+    except Exception as e:
+        # Inductor needs a C toolchain and Python headers; without them the first compiled call fails
+        if not _use_eager_vision_tower(model):
+            raise
+        log.warning(f"Compiling the vision tower failed ({e}). Running it eagerly.")
+        batch_size = warm_up(batch_size)
+
+    # CUDA events time the GPU work itself without forcing a sync at the start of the run
+    use_cuda_timing = device.type == "cuda"
+    if use_cuda_timing:
+        inference_start_event = torch.cuda.Event(enable_timing=True)
+        inference_end_event = torch.cuda.Event(enable_timing=True)
+        inference_start_event.record()
+    else:
+        inference_start_time = time.time()
+    cap = None
+    # The prefilter needs frames on the host before they are batched, so it implies CPU decoding
+    reader = _open_nvdec_reader(video_path, batch_size, "none" if motion_threshold is not None else hwaccel)
+    if reader is not None:
+        log.info("Decoding frames with NVDEC.")
+        total_frames = reader.get_src_stream_info(reader.default_video_stream).num_frames
+        frame_batches = _iter_frame_batches_nvdec_with_fallback(reader, video_path, crop_coords, batch_size, max_decode_size)
+    else:
+        cap = cv2.VideoCapture(str(video_path))
+        assert cap.isOpened(), f"Cannot open video: {video_path}"
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        # Decoding runs ahead in a background thread
+        frame_batches = _iter_frame_batches(cap, crop_coords, batch_size, max_decode_size, motion_threshold)
     log.info(f"Total frames to process: {total_frames}")
 
-    # Start GPU polling
-    global polling, gpu_utils
-    polling = True
-    gpu_utils.clear()
-    poll_thread = threading.Thread(target=poll_gpu_utilization)
-    poll_thread.start()
+    # Start GPU polling unless it was turned off for this run
+    gpu_utils = []
+    stop_polling = threading.Event()
+    poll_thread = None
+    if os.environ.get("GPU_UTIL_POLLING", "true").lower() == "true":
+        poll_thread = threading.Thread(target=poll_gpu_utilization, args=(stop_polling, gpu_utils), daemon=True)
+        poll_thread.start()
+
+    # Results are written by slice into preallocated columns; frame counts from the container
+    # header can be off, so the columns grow if more frames than expected are decoded
+    capacity = max(total_frames, batch_size)
+    results = {
+        "inference_frame_number": np.empty(capacity, dtype=np.int64),
+        "original_frame_number": np.empty(capacity, dtype=np.int64),
+        "timestamp_sec": np.empty(capacity, dtype=np.float64),
+        "predicted_label": np.empty(capacity, dtype=np.uint8), # 1 for "yes", 0 for "no"
+        "confidence": np.empty(capacity, dtype=np.float64),
+    }
+    num_results = 0
 
-    results = []
-    batch_images = []
-    batch_frame_numbers = []
-    
     pbar = tqdm(total=total_frames, desc="✨ Running Inference", unit="frame")
 
-    def process_batch():
-        """Processes a batch of frames."""
-        nonlocal batch_images, batch_frame_numbers
-        if not batch_images:
-            return
-
-        with torch.no_grad():
-            inputs = processor(images=batch_images, text=[prompt] * len(batch_images), return_tensors="pt", padding=True).to(device)
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens, # Use config value
-                output_scores=True,
-                return_dict_in_generate=True,
-            )
+    def record(frame_numbers, is_yes, confidences):
+        """Writes one row per frame into the result columns."""
+        nonlocal num_results
+        start, end = num_results, num_results + len(frame_numbers)
+        if end > len(results["confidence"]):
+            for name, column in results.items():
+                results[name] = np.resize(column, max(end, 2 * len(column)))
+
+        # Get timestamp info from the mapping, with a fallback if the frame
+        # is not in the CSV (should not happen in normal flow)
+        timestamps = [timestamp_map.get(frame_idx, (-1, round(frame_idx / target_fps, 2))) for frame_idx in frame_numbers]
+        results["inference_frame_number"][start:end] = frame_numbers
+        results["original_frame_number"][start:end] = [orig_frame_num for orig_frame_num, _ in timestamps]
+        results["timestamp_sec"][start:end] = [orig_timestamp for _, orig_timestamp in timestamps]
+        results["predicted_label"][start:end] = is_yes
+        results["confidence"][start:end] = confidences
+        num_results = end
+
+    def process_batch(frames, frame_numbers, skipped_frame_numbers):
+        """Processes a batch of frames; prefiltered frames are recorded with NaN confidence and filled in later."""
+        if skipped_frame_numbers:
+            record(skipped_frame_numbers, False, np.nan)
+        if frames is not None:
+            run_model(frames, frame_numbers)
+        pbar.update(len(frame_numbers) + len(skipped_frame_numbers))
+
+    def run_model(frames, frame_numbers):
+        """Runs the model on a batch of frames and records its answers."""
+        with torch.inference_mode():
+            if decision == "logits":
+                # Two-way softmax over the "yes" and "no" logits; confidence is the winning probability
+                yes_no_probs = F.softmax(run_batch(frames).logits[:, -1, yes_no_ids].float(), dim=-1)
+                confidences, answer_ids = yes_no_probs.max(dim=1)
+                record(frame_numbers, (answer_ids == 0).cpu().numpy(), confidences.cpu().numpy())
+                return
+
+            outputs = generate(frames)
 
             answers = processor.batch_decode(outputs.sequences, skip_special_tokens=True)
-            scores = outputs.scores
-            generated_tokens = outputs.sequences
-
-            for i in range(len(batch_images)):
-                answer = answers[i].lower().strip().split("\n")[-1]
-                token_probs = [
-                    F.softmax(step_logits, dim=-1)[i, token_id.item()].item()
-                    for step_logits, token_id in zip(scores, generated_tokens[i, -len(scores):])
-                ]
-
-                confidence = sum(token_probs) / len(token_probs) if token_probs else 0.0
-                frame_idx = batch_frame_numbers[i]
-                
-                # Get timestamp info from the dataframe
-                row = timestamps_df[timestamps_df["inference_frame_number"] == frame_idx]
-                if row.empty:
-                    # Fallback if frame not in CSV (should not happen in normal flow)
-                    orig_frame_num = None
-                    orig_timestamp = round(frame_idx / target_fps, 2)
-                else:
-                    orig_frame_num = int(row["original_frame_number"].values[0])
-                    orig_timestamp = float(row["original_timestamp_sec"].values[0])
-
-                pred_label = "yes" if "yes" in answer else "no"
-
-                results.append({
-                    "inference_frame_number": frame_idx,
-                    "original_frame_number": orig_frame_num,
-                    "timestamp_sec": orig_timestamp,
-                    "predicted_label": pred_label,
-                    "confidence": confidence
-                })
-        
-        pbar.update(len(batch_images))
-        batch_images.clear()
-        batch_frame_numbers.clear()
-
-    # Main video processing loop
-    frame_idx = 0
-    while True:
-        success, frame = cap.read()
-        if not success:
-            break
 
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        h, w, _ = frame_rgb.shape
-        # Use crop coordinates from config
-        crop_start = int(w * crop_coords['start'])
-        crop_end = int(w * crop_coords['end'])
-        cropped = frame_rgb[:, crop_start:crop_end]
-        img = Image.fromarray(cropped).resize((224, 224))
+            # Confidence is the mean probability of the generated tokens, computed for the
+            # whole batch on the GPU with a single copy back to the host
+            step_logits = torch.stack(outputs.scores, dim=1) # (batch, steps, vocab)
+            generated_tokens = outputs.sequences[:, -step_logits.shape[1]:]
+            token_log_probs = F.log_softmax(step_logits.float(), dim=-1).gather(-1, generated_tokens.unsqueeze(-1)).squeeze(-1)
+            confidences = token_log_probs.exp().mean(dim=1).cpu().numpy()
 
-        batch_images.append(img)
-        batch_frame_numbers.append(frame_idx)
+        record(frame_numbers, ["yes" in answer.lower().strip().split("\n")[-1] for answer in answers], confidences)
 
-        # Use batch_size from config
-        if len(batch_images) >= batch_size:
-            process_batch()
+    # Main video processing loop
+    for frames, frame_numbers, skipped_frame_numbers in frame_batches:
+        process_batch(frames, frame_numbers, skipped_frame_numbers)
 
-        frame_idx += 1
+    if use_cuda_timing:
+        inference_end_event.record()
+        inference_end_event.synchronize()
+        elapsed = inference_start_event.elapsed_time(inference_end_event) / 1000
+    else:
+        elapsed = time.time() - inference_start_time
 
-    process_batch() # Process the final batch
     pbar.close()
-    cap.release()
+    if cap is not None:
+        cap.release()
     
     # Stop GPU polling and report stats
-    polling = False
-    poll_thread.join()
+    stop_polling.set()
+    if poll_thread is not None:
+        poll_thread.join()
 
-    elapsed = time.time() - inference_start_time
     inference_fps = total_frames / elapsed if elapsed > 0 else 0
     avg_gpu_util = sum(gpu_utils) / len(gpu_utils) if gpu_utils else 0
     max_gpu_util = max(gpu_utils) if gpu_utils else 0
 
     log.info(f"Inference finished in {elapsed:.1f}s. Average FPS: {inference_fps:.2f}")
     log.info(f"GPU Utilization -> Average: {avg_gpu_util:.2f}%, Peak: {max_gpu_util:.2f}%")
-    return pd.DataFrame(results).sort_values("inference_frame_number")
+    # Frames are decoded in order; only skipped frames, recorded ahead of their batch, are out of order
+    if motion_threshold is None:
+        order = slice(num_results)
+    else:
+        order = np.argsort(results["inference_frame_number"][:num_results], kind="stable")
+    original_frame_number = results["original_frame_number"][order]
+    predicted_label = results["predicted_label"][order]
+    confidence = results["confidence"][order]
+    if motion_threshold is not None:
+        # A skipped frame barely differs from the last kept frame before it, so it takes that
+        # frame's answer; skipped frames with no kept frame before them stay "no" with zero confidence
+        skipped = np.isnan(confidence)
+        source = np.maximum.accumulate(np.where(skipped, -1, np.arange(len(confidence))))
+        inherited = source >= 0
+        predicted_label = np.where(inherited, predicted_label[source], 0).astype(np.uint8)
+        confidence = np.where(inherited, confidence[source], 0.0)
+    return pd.DataFrame({
+        "inference_frame_number": results["inference_frame_number"][order],
+        # -1 marks frames missing from the mapping; they become NaN as the None values used to
+        "original_frame_number": pd.Series(original_frame_number).where(original_frame_number >= 0),
+        "timestamp_sec": results["timestamp_sec"][order],
+        "predicted_label": predicted_label,
+        "confidence": confidence,
+    })
 
 
 # --- Post-Processing Functions ---
-def merge_intervals(intervals, max_gap_sec: float):
-    """Merges intervals that are closer than max_gap_sec."""
-    if not intervals:
-        return []
-    intervals = sorted(intervals, key=lambda x: x["start"])
-    merged = [intervals[0]]
-    for current in intervals[1:]:
-        prev = merged[-1]
-        if current["start"] - prev["end"] <= max_gap_sec: # Use config value
-            merged[-1]["end"] = max(prev["end"], current["end"])
-        else:
-            merged.append(current)
-    return merged
-
-def postprocess_predictions(df: pd.DataFrame, config: dict) -> list[dict]:
+def merge_intervals(starts: np.ndarray, ends: np.ndarray, max_gap_sec: float) -> np.ndarray:
+    """Merges intervals that are closer than max_gap_sec, returning an (N, 2) array of [start, end] rows."""
+    if len(starts) == 0:
+        return np.empty((0, 2))
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    # An interval opens a new group when it starts more than max_gap_sec after every earlier interval has ended
+    running_end = np.maximum.accumulate(ends)
+    group_starts = np.flatnonzero(np.concatenate(([True], starts[1:] - running_end[:-1] > max_gap_sec))) # Use config value
+    return np.column_stack((starts[group_starts], np.maximum.reduceat(ends, group_starts)))
+
+def postprocess_predictions(df: pd.DataFrame, config: dict) -> np.ndarray:
     """Filters, groups, and buffers raw predictions to create event intervals using config."""
-    df = df.copy()
     # Use confidence_threshold from config
-    df['status'] = df.apply(
-        lambda r: 'yes' if r['predicted_label'] == 'yes' and r['confidence'] >= config['confidence_threshold'] else 'no',
-        axis=1
-    )
-    yes_df = df[df['status'] == 'yes']
-    timestamps = yes_df['timestamp_sec'].tolist()
-    timestamps.sort()
-
-    groups = []
-    if timestamps:
-        current_group = [timestamps[0]]
-        for ts in timestamps[1:]:
-            # Use grouping_threshold_sec from config
-            if ts - current_group[-1] <= config['grouping_threshold_sec']:
-                current_group.append(ts)
-            else:
-                groups.append(current_group)
-                current_group = [ts]
-        groups.append(current_group)
+    is_yes = (df['predicted_label'].to_numpy() == 1) & (df['confidence'].to_numpy() >= config['confidence_threshold'])
+    timestamps = np.sort(df['timestamp_sec'].to_numpy(dtype=np.float64)[is_yes])
+    if len(timestamps) == 0:
+        return np.empty((0, 2))
+
+    # A new group starts wherever the gap to the previous detection exceeds grouping_threshold_sec
+    breaks = np.flatnonzero(np.diff(timestamps) > config['grouping_threshold_sec']) + 1
+    group_firsts = timestamps[np.concatenate(([0], breaks))]
+    group_lasts = timestamps[np.concatenate((breaks - 1, [len(timestamps) - 1]))]
 
-    predicted_intervals = []
-    for group in groups:
-        # Use buffer values from config
-        start = max(0, group[0] - config['buffer_start_sec'])
-        end = group[-1] + config['buffer_end_sec']
-        predicted_intervals.append({"start": round(start, 2), "end": round(end, 2)})
+    # Use buffer values from config
+    starts = np.round(np.maximum(0, group_firsts - config['buffer_start_sec']), 2)
+    ends = np.round(group_lasts + config['buffer_end_sec'], 2)
 
     # Use merge_gap_sec from config
-    return merge_intervals(predicted_intervals, max_gap_sec=config['merge_gap_sec'])
+    return merge_intervals(starts, ends, max_gap_sec=config['merge_gap_sec'])
 
 
 # --- Main Orchestrator for this Stage ---
@@ -235,25 +681,46 @@ def run_inference(
     inference_config: dict,
     post_proc_config: dict,
     target_fps: int,
+    model_and_processor: tuple = None,
 ) -> Path:
-    """Orchestrates the inference and post-processing stage using config parameters."""
-    # Pass model_id from config
-    model, processor = load_model(model_id=inference_config['model_id'])
+    """
+    Orchestrates the inference and post-processing stage using config parameters.
+
+    A (model, processor) pair that was already loaded, e.g. in the background while
+    downsampling ran, can be passed in via model_and_processor to skip loading here.
+    """
+    if model_and_processor is None:
+        # Pass model_id from config
+        model_and_processor = load_model(
+            model_id=inference_config['model_id'],
+            quantization=inference_config.get('quantization', 'none'),
+            compile_vision_tower=inference_config.get('compile_vision_tower', False),
+        )
+    model, processor = model_and_processor
     
     # More robust way to get the original video stem
     video_stem = downsampled_video_path.stem.rsplit('_', 1)[0]
 
-    timestamps_df = pd.read_csv(timestamps_csv_path)
+    timestamps_df = pd.read_csv(timestamps_csv_path, engine="pyarrow")
+    # Index the mapping by inference frame once so each per-frame lookup is a dict hit, not a dataframe scan
+    timestamp_map = dict(zip(
+        timestamps_df["inference_frame_number"].tolist(),
+        zip(timestamps_df["original_frame_number"].tolist(), timestamps_df["original_timestamp_sec"].tolist())
+    ))
     
     raw_predictions_df = _run_inference_on_video(
-        model, processor, downsampled_video_path, timestamps_df, prompt,
+        model, processor, downsampled_video_path, timestamp_map, prompt,
         batch_size=inference_config['batch_size'],
         crop_coords={
             'start': inference_config['crop_width_start'],
             'end': inference_config['crop_width_end']
         },
         max_new_tokens=inference_config.get('max_new_tokens', 5), # Use get for safe access
-        target_fps=target_fps
+        target_fps=target_fps,
+        hwaccel=inference_config.get('hwaccel', 'none'),
+        motion_threshold=inference_config['prefilter_motion_threshold'] if inference_config.get('prefilter_enabled', False) else None,
+        decision=inference_config.get('decision', 'generate'),
+        quantization=inference_config.get('quantization', 'none')
     )
 
     log.info(f"Post-processing predictions with threshold {post_proc_config['confidence_threshold']}...")
@@ -264,7 +731,7 @@ def run_inference(
 
 
     intervals_csv_path = output_dir / f"{video_stem}_predicted_intervals.csv"
-    pd.DataFrame(predicted_intervals).to_csv(intervals_csv_path, index=False)
+    pd.DataFrame(predicted_intervals, columns=["start", "end"]).to_csv(intervals_csv_path, index=False)
     log.info(f"Saved {len(predicted_intervals)} predicted intervals to: {intervals_csv_path}")
 
     return intervals_csv_path